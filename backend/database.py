@@ -1,92 +1,210 @@
+import asyncio
 import aiosqlite
-import json
 import os
+from contextlib import asynccontextmanager
+from fastapi import HTTPException
+from urllib.request import pathname2url
 
 DB_NAME = "roddle.db"
+POOL_SIZE = 8
+# Seconds to wait for a free reader before failing the request with 503
+POOL_TIMEOUT = 5
 
-# FastAPI Dependency
-async def get_db():
-    async with aiosqlite.connect(DB_NAME) as db:
-        db.row_factory = aiosqlite.Row
+# journal_mode is persisted in the database file, so init_db sets it once.
+# The rest are per-connection and must be applied to every new connection.
+CONNECTION_PRAGMAS = """
+    PRAGMA synchronous=NORMAL;
+    PRAGMA cache_size=-64000;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA mmap_size=268435456;
+    PRAGMA foreign_keys=ON;
+    PRAGMA busy_timeout=5000;
+"""
+
+# Long-lived connections, opened once at startup: a pool of read-only connections
+# checked out per request, plus a single writer so concurrent writes queue on a lock
+# instead of racing for SQLite's write lock and retrying on SQLITE_BUSY.
+_pool: asyncio.Queue = None
+_write_db: aiosqlite.Connection = None
+_write_lock: asyncio.Lock = None
+
+async def _connect(read_only=False):
+    if read_only:
+        uri = f"file:{pathname2url(os.path.abspath(DB_NAME))}?mode=ro"
+        db = await aiosqlite.connect(uri, uri=True)
+    else:
+        db = await aiosqlite.connect(DB_NAME)
+    db.row_factory = aiosqlite.Row
+    await db.executescript(CONNECTION_PRAGMAS)
+    return db
+
+async def _release(db):
+    # Never hand a half-finished transaction to the next request
+    if db.in_transaction:
+        await db.rollback()
+
+async def init_pool(size: int = POOL_SIZE):
+    global _pool, _write_db, _write_lock
+    _pool = asyncio.Queue()
+    for _ in range(size):
+        _pool.put_nowait(await _connect(read_only=True))
+    _write_db = await _connect()
+    _write_lock = asyncio.Lock()
+
+async def close_pool():
+    global _pool, _write_db
+    if _pool is not None:
+        while not _pool.empty():
+            db = _pool.get_nowait()
+            await db.close()
+        _pool = None
+    if _write_db is not None:
+        await _write_db.close()
+        _write_db = None
+
+@asynccontextmanager
+async def read_connection():
+    # Short checkout for handlers that must not hold a reader across slow work (e.g. the LLM)
+    try:
+        db = await asyncio.wait_for(_pool.get(), POOL_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="Database busy, try again")
+    try:
+        yield db
+    finally:
+        await _release(db)
+        _pool.put_nowait(db)
+
+@asynccontextmanager
+async def write_connection():
+    async with _write_lock:
+        try:
+            yield _write_db
+        finally:
+            await _release(_write_db)
+
+# FastAPI Dependencies
+async def get_db_read():
+    async with read_connection() as db:
+        yield db
+
+async def get_db_write():
+    async with write_connection() as db:
         yield db
 
+# Query helpers
+async def fetch_one(db, sql, params=()):
+    # execute_fetchall runs the statement and fetches in a single hop to the
+    # connection's worker thread; meant for lookups returning at most one row
+    rows = await db.execute_fetchall(sql, params)
+    return rows[0] if rows else None
+
+# Schema migrations, gated on PRAGMA user_version so they only run once per database
+SCHEMA_VERSION = 2
+
+# v1: columns added after the first release, as (table, column, definition)
+_V1_COLUMNS = [
+    ("users", "total_score", "INTEGER DEFAULT 0"),
+    ("users", "premium", "BOOLEAN DEFAULT 0"),
+    ("users", "settings", "TEXT DEFAULT '{}'"),
+    ("riddles", "user_id", "INTEGER"),
+]
+
+async def migrate(db):
+    async with db.execute("PRAGMA user_version") as cursor:
+        version = (await cursor.fetchone())[0]
+
+    if version < 1:
+        # Tables created by older builds lack these columns; freshly created ones already have them
+        for table, column, definition in _V1_COLUMNS:
+            async with db.execute(f"PRAGMA table_info({table})") as cursor:
+                columns = {row[1] for row in await cursor.fetchall()}
+            if column not in columns:
+                await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    if version < 2:
+        # Superseded by the covering idx_up_user_status in INDEX_SQL
+        await db.execute("DROP INDEX IF EXISTS idx_progress_user_status")
+
+    if version < SCHEMA_VERSION:
+        await db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+# Schema, run as one executescript at startup
+SCHEMA_SQL = """
+    PRAGMA journal_mode=WAL;
+
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        hashed_password TEXT NOT NULL,
+        total_score INTEGER DEFAULT 0,
+        premium BOOLEAN DEFAULT 0,
+        settings TEXT DEFAULT '{}',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE TABLE IF NOT EXISTS riddles (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        content TEXT NOT NULL,
+        answer TEXT NOT NULL,
+        difficulty TEXT NOT NULL,
+        date_for DATE,
+        user_id INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    );
+
+    CREATE TABLE IF NOT EXISTS user_progress (
+        user_id INTEGER,
+        riddle_id INTEGER,
+        guesses TEXT,  -- JSON list of guesses
+        status TEXT,   -- 'playing', 'solved', 'failed'
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, riddle_id),
+        FOREIGN KEY(user_id) REFERENCES users(id),
+        FOREIGN KEY(riddle_id) REFERENCES riddles(id)
+    );
+
+    CREATE TABLE IF NOT EXISTS friend_requests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender_id INTEGER NOT NULL,
+        receiver_id INTEGER NOT NULL,
+        status TEXT DEFAULT 'pending', -- pending, accepted, rejected
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(sender_id) REFERENCES users(id),
+        FOREIGN KEY(receiver_id) REFERENCES users(id),
+        UNIQUE(sender_id, receiver_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS friends (
+        user_id INTEGER,
+        friend_id INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, friend_id),
+        FOREIGN KEY(user_id) REFERENCES users(id),
+        FOREIGN KEY(friend_id) REFERENCES users(id)
+    );
+"""
+
+# Indexes run after migrate(), since databases from older builds only gain some
+# of the indexed columns there
+INDEX_SQL = """
+    -- riddle/progress JOINs in generate_riddle and daily-status
+    CREATE INDEX IF NOT EXISTS idx_riddles_diff_date ON riddles(difficulty, date_for);
+    CREATE INDEX IF NOT EXISTS idx_riddles_date ON riddles(date_for);
+    -- riddle_id makes it covering: the join to riddles is resolved from the index alone
+    CREATE INDEX IF NOT EXISTS idx_up_user_status ON user_progress(user_id, status, riddle_id);
+    -- global leaderboard: ORDER BY total_score DESC LIMIT 10 becomes an index walk instead of a sort
+    CREATE INDEX IF NOT EXISTS idx_users_score ON users(total_score DESC);
+
+    -- refresh planner statistics so the indexes get picked
+    ANALYZE;
+"""
+
 # Startup Init (Uses connect directly)
 async def init_db():
     async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                hashed_password TEXT NOT NULL,
-                total_score INTEGER DEFAULT 0,
-                premium BOOLEAN DEFAULT 0,
-                settings TEXT DEFAULT '{}',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Migration: Ensure premium column exists for existing tables
-        try:
-            await db.execute("ALTER TABLE users ADD COLUMN premium BOOLEAN DEFAULT 0")
-        except Exception:
-            pass
-
-        # Migration: Ensure settings column exists
-        try:
-            await db.execute("ALTER TABLE users ADD COLUMN settings TEXT DEFAULT '{}'")
-        except Exception:
-            pass
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS riddles (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                content TEXT NOT NULL,
-                answer TEXT NOT NULL,
-                difficulty TEXT NOT NULL,
-                date_for DATE,
-                user_id INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(user_id) REFERENCES users(id)
-            )
-        """)
-        
-        # Migration: Ensure user_id column exists for existing riddles table
-        try:
-            await db.execute("ALTER TABLE riddles ADD COLUMN user_id INTEGER")
-        except Exception:
-            pass
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS user_progress (
-                user_id INTEGER,
-                riddle_id INTEGER,
-                guesses TEXT,  -- JSON list of guesses
-                status TEXT,   -- 'playing', 'solved', 'failed'
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (user_id, riddle_id),
-                FOREIGN KEY(user_id) REFERENCES users(id),
-                FOREIGN KEY(riddle_id) REFERENCES riddles(id)
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS friend_requests (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender_id INTEGER NOT NULL,
-                receiver_id INTEGER NOT NULL,
-                status TEXT DEFAULT 'pending', -- pending, accepted, rejected
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(sender_id) REFERENCES users(id),
-                FOREIGN KEY(receiver_id) REFERENCES users(id),
-                UNIQUE(sender_id, receiver_id)
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS friends (
-                user_id INTEGER,
-                friend_id INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (user_id, friend_id),
-                FOREIGN KEY(user_id) REFERENCES users(id),
-                FOREIGN KEY(friend_id) REFERENCES users(id)
-            )
-        """)
+        await db.executescript(SCHEMA_SQL)
+        await migrate(db)
         await db.commit()
+        await db.executescript(INDEX_SQL)
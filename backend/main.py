@@ -1,12 +1,21 @@
-from fastapi import FastAPI, HTTPException, Depends, status, Request
+from fastapi import FastAPI, HTTPException, Depends, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from datetime import datetime, date, timedelta, timezone as dt_timezone
+import asyncio
 import aiosqlite
+import functools
+import hmac
 import json
 import os
-from typing import Optional, List, Dict
+import re
+import string
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from typing import Any, Optional, List, Dict
 from jose import jwt, JWTError
 from fastapi.security import OAuth2PasswordBearer
 import logging
@@ -15,24 +24,74 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-from database import init_db, get_db
+from database import init_db, init_pool, close_pool, get_db_read, get_db_write, read_connection, write_connection, fetch_one
 from llm import llm_engine
 
 app = FastAPI(title="Roddle Standalone")
 
-from passlib.context import CryptContext
+import bcrypt
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 
 # Config
 SECRET_KEY = "dev_secret_standalone_key"
 ALGORITHM = "HS256"
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Game tables
+DIFFICULTIES = ("easy", "medium", "hard", "very_hard", "insane")
+# Read-only views: shared by every request, so nothing may mutate them
+GUESS_MAP = MappingProxyType({"easy": 5, "medium": 4, "hard": 3, "very_hard": 2, "insane": 1})
+BASE_POINTS = MappingProxyType({"easy": 100, "medium": 200, "hard": 300, "very_hard": 400, "insane": 500})
+
+# Registration rules (see register)
+# Allowed-charset checks strip the allowed bytes with bytes.translate; anything left
+# over is disallowed. Non-ASCII (including lone surrogates, which can't be encoded at
+# all) is rejected before encoding.
+_USERNAME_CHARS = (string.ascii_letters + string.digits).encode()
+_PW_CHARS = _USERNAME_CHARS + b"/\\?!.><[]"
+
+def _only_chars(value, allowed):
+    return bool(value) and value.isascii() and not value.encode("ascii").translate(None, allowed)
+
+_PW_UPPER_RE = re.compile(r"[A-Z]")
+_PW_DIGIT_RE = re.compile(r"[0-9]")
+_PW_SYMBOL_RE = re.compile(r"[/\\?!.><\[\]]")
+
+# New hashes are Argon2id. Older rows hold bcrypt ($2b$, as passlib wrote them);
+# those still verify and are re-hashed to Argon2id on the next successful login.
+# Cost is tunable per deployment (e.g. cheaper on a slow dev VM); stored hashes made
+# with other parameters still verify and are re-hashed on the next login.
+ARGON2_TIME_COST = int(os.getenv("ARGON2_TIME_COST", "2"))
+ARGON2_MEMORY_COST = int(os.getenv("ARGON2_MEMORY_COST", "19456"))  # KiB
+_ph = PasswordHasher(time_cost=ARGON2_TIME_COST, memory_cost=ARGON2_MEMORY_COST, parallelism=1)
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    try:
+        return _ph.verify(hashed_password, plain_password)
+    except VerificationError:
+        return False
+    except InvalidHashError:
+        return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
+
+def password_needs_rehash(hashed_password):
+    try:
+        return _ph.check_needs_rehash(hashed_password)
+    except InvalidHashError:
+        return True
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return _ph.hash(password)
+
+# Hashing takes tens of ms of CPU; run it on its own workers so it doesn't stall the
+# event loop, and a login burst can't crowd out other to_thread work in the default
+# executor. argon2 and bcrypt release the GIL, so threads use every core.
+KDF_EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="kdf")
+
+async def averify_password(plain_password, hashed_password):
+    return await asyncio.get_running_loop().run_in_executor(KDF_EXECUTOR, verify_password, plain_password, hashed_password)
+
+async def aget_password_hash(password):
+    return await asyncio.get_running_loop().run_in_executor(KDF_EXECUTOR, get_password_hash, password)
 
 # CORS
 app.add_middleware(
@@ -45,6 +104,15 @@ app.add_middleware(
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/auth/login")
 
+# Local inference takes seconds; run it on one dedicated worker so generations queue up
+# for the model instead of freezing the event loop (and every other request) meanwhile.
+LLM_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm")
+
+async def set_active_model(model_name):
+    # Model swaps go through the same single worker as generation, so a swap can never
+    # land on the model while it is mid-completion, and the load doesn't block the loop
+    return await asyncio.get_running_loop().run_in_executor(LLM_EXECUTOR, llm_engine.set_active_model, model_name)
+
 # --- Models ---
 class UserCreate(BaseModel):
     username: str
@@ -71,6 +139,31 @@ class FriendRequest(BaseModel):
 class FriendAction(BaseModel):
     request_id: int
 
+class SettingsUpdate(BaseModel):
+    # Any settings keys are accepted and stored as-is
+    model_config = ConfigDict(extra="allow")
+    preferred_model: Optional[str] = None
+
+class PullModelRequest(BaseModel):
+    model_name: Optional[str] = None
+    model: Optional[str] = None
+
+# Response models for the hottest reads; FastAPI serializes these through pydantic-core
+class UserOut(BaseModel):
+    id: int
+    username: str
+    premium: bool
+    total_score: Optional[int] = None
+    settings: Dict[str, Any] = {}
+
+class LeaderboardEntry(BaseModel):
+    username: str
+    total_score: int
+
+class PendingRequestOut(BaseModel):
+    id: int
+    sender_username: str
+
 # --- Auth Helpers ---
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -79,7 +172,19 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: aiosqlite.Connection = Depends(get_db)):
+# Decoded tokens: token -> (user_id, expires_at). Clients send the same token on every
+# call, so repeat hits skip jose's HMAC check and JSON parse. Entries expire at the
+# earlier of the JWT's own exp and TOKEN_CACHE_TTL; invalid tokens are never cached.
+TOKEN_CACHE_SIZE = 10_000
+TOKEN_CACHE_TTL = 60  # seconds
+_token_cache: Dict[str, tuple] = {}
+
+def decode_user_id(token: str):
+    now = time.time()
+    cached = _token_cache.get(token)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id = payload.get("sub")
@@ -87,25 +192,66 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: aiosqlite.Co
             raise HTTPException(status_code=401, detail="Invalid token")
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
-    
-    async with db.execute("SELECT * FROM users WHERE id = ?", (user_id,)) as cursor:
-        user = await cursor.fetchone()
-        if user is None:
-            raise HTTPException(status_code=401, detail="User not found")
-        return user
+
+    if len(_token_cache) >= TOKEN_CACHE_SIZE:
+        _token_cache.clear()
+    _token_cache[token] = (user_id, min(payload.get("exp", 0), now + TOKEN_CACHE_TTL))
+    return user_id
+
+async def load_user(db, user_id):
+    # Only the columns route handlers read; skips hashed_password and created_at
+    user = await fetch_one(db, "SELECT id, username, total_score, premium, settings FROM users WHERE id = ?", (user_id,))
+    if user is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    return user
+
+# Users by id, so authenticated requests skip both jose and SQLite on repeat calls.
+# Entries are dropped on every write to the user's row and otherwise live USER_CACHE_TTL.
+USER_CACHE_SIZE = 10_000
+USER_CACHE_TTL = 30  # seconds
+_user_cache: Dict[str, tuple] = {}  # str(user_id) -> (expires_at, user dict)
+# Bumped on every invalidation. A load that started before a bump may hold a pre-write
+# row, so it isn't stored; that only costs a cache miss on the next request.
+_user_cache_generation = 0
+
+def invalidate_user(user_id):
+    global _user_cache_generation
+    _user_cache_generation += 1
+    _user_cache.pop(str(user_id), None)
+
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+    user_id = str(decode_user_id(token))
+    now = time.monotonic()
+    cached = _user_cache.get(user_id)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+
+    # Only a cache miss checks out a reader, and only for this one lookup
+    generation = _user_cache_generation
+    async with read_connection() as db:
+        user = dict(await load_user(db, user_id))
+    if generation == _user_cache_generation:
+        if len(_user_cache) >= USER_CACHE_SIZE:
+            _user_cache.clear()
+        _user_cache[user_id] = (now + USER_CACHE_TTL, user)
+    return user
 
 # --- Startup ---
 @app.on_event("startup")
 async def startup_event():
     await init_db()
+    await init_pool()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_pool()
 
 # --- Routes ---
 
 @app.post("/api/auth/register")
-async def register(user: UserCreate, db: aiosqlite.Connection = Depends(get_db)):
-    import re
+async def register(user: UserCreate):
     # Validate Username
-    if not re.match(r"^[a-zA-Z0-9]+$", user.username):
+    if not _only_chars(user.username, _USERNAME_CHARS):
         raise HTTPException(status_code=400, detail="Username must contain only letters and numbers")
         
     # Validate Password
@@ -114,87 +260,100 @@ async def register(user: UserCreate, db: aiosqlite.Connection = Depends(get_db))
     # Allowed chars: [a-zA-Z0-9/\\?!.><\[\]]
     # Requirements: At least one uppercase [A-Z], one digit [0-9], one symbol [/\?!.><\[\]]
     
-    allowed_pattern = r"^[a-zA-Z0-9/\\?!.><\[\]]+$"
-    if not re.match(allowed_pattern, user.password):
+    if not _only_chars(user.password, _PW_CHARS):
         raise HTTPException(status_code=400, detail="Password contains invalid characters. Allowed: letters, numbers, /\\?!.><[]")
         
-    if not re.search(r"[A-Z]", user.password):
+    if not _PW_UPPER_RE.search(user.password):
         raise HTTPException(status_code=400, detail="Password must contain at least one uppercase letter")
-    if not re.search(r"[0-9]", user.password):
+    if not _PW_DIGIT_RE.search(user.password):
         raise HTTPException(status_code=400, detail="Password must contain at least one number")
-    if not re.search(r"[/\\?!.><\[\]]", user.password):
+    if not _PW_SYMBOL_RE.search(user.password):
         raise HTTPException(status_code=400, detail="Password must contain at least one special character: /\\?!.><[]")
 
     try:
-        # Check existing
-        async with db.execute("SELECT id FROM users WHERE username = ?", (user.username,)) as cursor:
-            if await cursor.fetchone():
-                raise HTTPException(status_code=400, detail="Username already exists")
+        # Check existing; the reader goes back to the pool before hashing
+        async with read_connection() as db:
+            existing = await fetch_one(db, "SELECT id FROM users WHERE username = ?", (user.username,))
+        if existing:
+            raise HTTPException(status_code=400, detail="Username already exists")
                 
-        await db.execute("INSERT INTO users (username, hashed_password) VALUES (?, ?)", 
-                         (user.username, get_password_hash(user.password))) 
-        await db.commit()
-        
-        # Determine ID
-        async with db.execute("SELECT id, username FROM users WHERE username = ?", (user.username,)) as cursor:
-            new_user = await cursor.fetchone()
+        # Hash before taking the write connection so other writers aren't held up by password hashing
+        hashed_password = await aget_password_hash(user.password)
+        async with write_connection() as wdb:
+            # RETURNING gives us the new ID; ON CONFLICT covers a name taken since the check above
+            new_user = await fetch_one(wdb, """
+                INSERT INTO users (username, hashed_password) VALUES (?, ?)
+                ON CONFLICT(username) DO NOTHING
+                RETURNING id, username
+            """, (user.username, hashed_password))
+            await wdb.commit()
+        if new_user is None:
+            raise HTTPException(status_code=400, detail="Username already exists")
             
         token = create_access_token(data={"sub": str(new_user['id'])})
         
-        # Log active model
-        model_status = llm_engine.get_status()
-        print(f"User '{new_user['username']}' registered. Active Model: {model_status.get('model', 'Unknown')}")
+        logger.info("User '%s' registered.", new_user['username'])
         
         return {
             "token": token,
             "user": {"id": new_user['id'], "username": new_user['username']}
         }
+    except HTTPException:
+        raise
     except Exception as e:
-        print(e)
+        logger.error("Registration failed: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/auth/login")
-async def login(user: UserLogin, db: aiosqlite.Connection = Depends(get_db)):
-    async with db.execute("SELECT * FROM users WHERE username = ?", (user.username,)) as cursor:
-        row = await cursor.fetchone()
-        if not row or not verify_password(user.password, row['hashed_password']):
-            raise HTTPException(status_code=401, detail="Invalid credentials")
-        
-        settings = {}
-        if row['settings']:
-            try:
-                settings = json.loads(row['settings'])
-            except: 
-                pass
-
-        # Apply preferred model if set
-        warning = None
-        if settings.get('preferred_model'):
-            model_name = settings['preferred_model']
-            success = llm_engine.set_active_model(model_name)
-            if not success:
-               warning = f"Preferred model '{model_name}' could not be loaded. Switched to default."
-               # potentially clear the preference effectively in memory or just warn
-        
-        token = create_access_token(data={"sub": str(row['id'])})
-        
-        # Log active model
-        model_status = llm_engine.get_status()
-        print(f"User '{row['username']}' logged in. Active Model: {model_status.get('model', 'Unknown')}")
-        
-        return {
-            "token": token,
-            "user": {
-                "id": row['id'], 
-                "username": row['username'],
-                "total_score": row['total_score'],
-                "premium": bool(row['premium']),
-                "settings": settings
-            },
-            "warning": warning
-        }
+async def login(user: UserLogin):
+    # Only the lookup holds a reader; verify and any rehash run after it is back in the pool
+    async with read_connection() as db:
+        row = await fetch_one(db, "SELECT id, username, hashed_password, total_score, premium, settings FROM users WHERE username = ?", (user.username,))
+    if not row or not await averify_password(user.password, row['hashed_password']):
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    
+    # Transparently move legacy bcrypt (or outdated Argon2 parameters) to the current hash
+    if password_needs_rehash(row['hashed_password']):
+        new_hash = await aget_password_hash(user.password)
+        async with write_connection() as wdb:
+            await wdb.execute("UPDATE users SET hashed_password = ? WHERE id = ?", (new_hash, row['id']))
+            await wdb.commit()
+    
+    settings = {}
+    if row['settings']:
+        try:
+            settings = json.loads(row['settings'])
+        except: 
+            pass
+
+    # Apply preferred model if set
+    warning = None
+    if settings.get('preferred_model'):
+        model_name = settings['preferred_model']
+        success = await set_active_model(model_name)
+        if not success:
+           warning = f"Preferred model '{model_name}' could not be loaded. Switched to default."
+           # potentially clear the preference effectively in memory or just warn
+    
+    token = create_access_token(data={"sub": str(row['id'])})
+    
+    # Log active model; the engine is only asked when the line will actually be emitted
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("User '%s' logged in. Active Model: %s", row['username'], llm_engine.get_status().get('model', 'Unknown'))
+    
+    return {
+        "token": token,
+        "user": {
+            "id": row['id'], 
+            "username": row['username'],
+            "total_score": row['total_score'],
+            "premium": bool(row['premium']),
+            "settings": settings
+        },
+        "warning": warning
+    }
 
-@app.get("/api/auth/me")
+@app.get("/api/auth/me", response_model=UserOut)
 async def get_me(user = Depends(get_current_user)):
     settings = {}
     if user['settings']:
@@ -212,122 +371,129 @@ async def get_me(user = Depends(get_current_user)):
     }
 
 @app.post("/api/premium/unlock")
-async def unlock_premium(user = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+async def unlock_premium(user = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db_write)):
     await db.execute("UPDATE users SET premium = 1 WHERE id = ?", (user['id'],))
     await db.commit()
-    print(f"User {user['username']} unlocked premium!")
+    invalidate_user(user['id'])
+    logger.info("User %s unlocked premium!", user['username'])
     return {"success": True}
 
 @app.get("/api/riddles/daily-status")
-async def get_daily_status(user = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
-    difficulties = ["easy", "medium", "hard", "very_hard", "insane"]
-    status_map = {}
-    today = date.today().isoformat()
+async def get_daily_status(user = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db_read)):
+    today = date.today()
 
     # Check progress for each difficulty
-    async with db.execute("SELECT r.difficulty, up.status FROM user_progress up JOIN riddles r ON up.riddle_id = r.id WHERE up.user_id = ? AND r.date_for = ?", (user['id'], today)) as cursor:
-        rows = await cursor.fetchall()
-        progress_dict = {row['difficulty']: row['status'] for row in rows}
-
-    for diff in difficulties:
-        # Determine if accessible (premium check normally)
-        accessible = True 
-        p_status = progress_dict.get(diff)
-        
-        status_map[diff] = {
-            "accessible": accessible,
-            "completed": p_status == "solved" or p_status == "failed", # Treat failed as completed for day? Or just solved?
-            "started": p_status == "playing",
-            "locked": not accessible
+    rows = await db.execute_fetchall("SELECT r.difficulty, up.status FROM user_progress up JOIN riddles r ON up.riddle_id = r.id WHERE up.user_id = ? AND r.date_for = ?", (user['id'], today.isoformat()))
+    progress_dict = {row['difficulty']: row['status'] for row in rows}
+
+    # Every difficulty is accessible for now (premium check normally).
+    # Failed counts as completed for the day.
+    status_map = {
+        diff: {
+            "accessible": True,
+            "completed": progress_dict.get(diff) in ("solved", "failed"),
+            "started": progress_dict.get(diff) == "playing",
+            "locked": False
         }
+        for diff in DIFFICULTIES
+    }
         
     return {
-        "day": date.today().day,
-        "month": date.today().strftime("%Y-%m"),
+        "day": today.day,
+        "month": today.strftime("%Y-%m"),
         "status": status_map,
         "needs_generation": False
     }
 
-@app.get("/api/leaderboard/global")
-async def get_global_leaderboard(db: aiosqlite.Connection = Depends(get_db)):
+# Top-10 rarely changes; serve it from memory for LEADERBOARD_CACHE_TTL seconds.
+# submit_guess drops the cache whenever a score changes, via invalidate_leaderboard.
+LEADERBOARD_CACHE_TTL = 15  # seconds
+_leaderboard_cache = None  # (monotonic timestamp, result)
+# Bumped on invalidation so a query that started before a score change isn't stored
+_leaderboard_generation = 0
+
+def invalidate_leaderboard():
+    global _leaderboard_cache, _leaderboard_generation
+    _leaderboard_generation += 1
+    _leaderboard_cache = None
+
+@app.get("/api/leaderboard/global", response_model=List[LeaderboardEntry])
+async def get_global_leaderboard(db: aiosqlite.Connection = Depends(get_db_read)):
+    global _leaderboard_cache
+    now = time.monotonic()
+    if _leaderboard_cache is not None and now - _leaderboard_cache[0] < LEADERBOARD_CACHE_TTL:
+        return _leaderboard_cache[1]
+
     # Simple score based on user table (needs total_score Logic elsewhere really, but for now just returning users)
     # We didn't implement total_score incrementing in main.py yet, let's fix that in submit_guess too.
-    async with db.execute("SELECT username, total_score FROM users ORDER BY total_score DESC LIMIT 10") as cursor:
-        users = await cursor.fetchall()
-    return [{"username": u['username'], "total_score": u['total_score'] or 0} for u in users]
-
-@app.get("/api/leaderboard/friends")
-async def get_friends_leaderboard(user = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
-    # Get friends IDs
-    async with db.execute("SELECT friend_id FROM friends WHERE user_id = ?", (user['id'],)) as cursor:
-        rows = await cursor.fetchall()
-        friend_ids = [row['friend_id'] for row in rows]
-    
-    # Always include self
-    friend_ids.append(user['id'])
-    
-    if not friend_ids:
-        return [{"username": user['username'], "total_score": user['total_score'] or 0}]
-
-    placeholders = ",".join("?" * len(friend_ids))
-    async with db.execute(f"SELECT username, total_score FROM users WHERE id IN ({placeholders}) ORDER BY total_score DESC", tuple(friend_ids)) as cursor:
-        users = await cursor.fetchall()
+    generation = _leaderboard_generation
+    users = await db.execute_fetchall("SELECT username, COALESCE(total_score, 0) FROM users ORDER BY total_score DESC LIMIT 10")
+    result = [{"username": username, "total_score": score} for username, score in users]
+    if generation == _leaderboard_generation:
+        _leaderboard_cache = (now, result)
+    return result
+
+@app.get("/api/leaderboard/friends", response_model=List[LeaderboardEntry])
+async def get_friends_leaderboard(user = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db_read)):
+    # Friends plus self, collected and ranked in one statement
+    users = await db.execute_fetchall("""
+        WITH ids AS (SELECT friend_id AS id FROM friends WHERE user_id = ? UNION SELECT ?)
+        SELECT u.username, COALESCE(u.total_score, 0) FROM users u JOIN ids ON u.id = ids.id
+        ORDER BY u.total_score DESC
+    """, (user['id'], user['id']))
         
-    return [{"username": u['username'], "total_score": u['total_score'] or 0} for u in users]
+    return [{"username": username, "total_score": score} for username, score in users]
 
 @app.post("/api/friends/request")
-async def send_friend_request(req: FriendRequest, user = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
-    # Check target user exists
-    async with db.execute("SELECT id FROM users WHERE username = ?", (req.friend_username,)) as cursor:
-        target = await cursor.fetchone()
-        if not target:
-            raise HTTPException(404, "User not found")
-        if target['id'] == user['id']:
-             raise HTTPException(400, "Cannot add yourself")
+async def send_friend_request(req: FriendRequest, user = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db_write)):
+    # Target user, existing friendship and pending request (outgoing or incoming) in one lookup
+    target = await fetch_one(db, """
+        SELECT u.id,
+               EXISTS(SELECT 1 FROM friends WHERE user_id = ? AND friend_id = u.id) AS is_friend,
+               EXISTS(SELECT 1 FROM friend_requests
+                      WHERE (sender_id = ? AND receiver_id = u.id) OR (sender_id = u.id AND receiver_id = ?)) AS pending
+        FROM users u
+        WHERE u.username = ?
+    """, (user['id'], user['id'], user['id'], req.friend_username))
+    if not target:
+        raise HTTPException(404, "User not found")
+    if target['id'] == user['id']:
+         raise HTTPException(400, "Cannot add yourself")
+    if target['is_friend']:
+        raise HTTPException(400, "Already friends")
+    if target['pending']:
+         raise HTTPException(400, "Request already pending")
              
     target_id = target['id']
-    
-    # Check existing request or friendship
-    # Check if already friends
-    async with db.execute("SELECT 1 FROM friends WHERE user_id = ? AND friend_id = ?", (user['id'], target_id)) as cursor:
-        if await cursor.fetchone():
-            raise HTTPException(400, "Already friends")
-
-    # Check pending request (outgoing or incoming)
-    async with db.execute("SELECT 1 FROM friend_requests WHERE (sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?)", 
-                          (user['id'], target_id, target_id, user['id'])) as cursor:
-        if await cursor.fetchone():
-             raise HTTPException(400, "Request already pending")
 
     await db.execute("INSERT INTO friend_requests (sender_id, receiver_id) VALUES (?, ?)", (user['id'], target_id))
     await db.commit()
     return {"success": True}
 
-@app.get("/api/friends/requests/pending")
-async def get_pending_requests(user = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
-    async with db.execute("""
+@app.get("/api/friends/requests/pending", response_model=List[PendingRequestOut])
+async def get_pending_requests(user = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db_read)):
+    reqs = await db.execute_fetchall("""
         SELECT fr.id, u.username as sender_username 
         FROM friend_requests fr
         JOIN users u ON fr.sender_id = u.id
         WHERE fr.receiver_id = ? AND fr.status = 'pending'
-    """, (user['id'],)) as cursor:
-        reqs = await cursor.fetchall()
-    return [{"id": r['id'], "sender_username": r['sender_username']} for r in reqs]
+    """, (user['id'],))
+    return [{"id": req_id, "sender_username": sender} for req_id, sender in reqs]
 
 @app.post("/api/friends/requests/accept")
-async def accept_friend_request(action: FriendAction, user = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+async def accept_friend_request(action: FriendAction, user = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db_write)):
+    await db.execute("BEGIN IMMEDIATE")
+    
     # Verify request exists and is for me
-    async with db.execute("SELECT sender_id, receiver_id FROM friend_requests WHERE id = ? AND receiver_id = ? AND status = 'pending'", (action.request_id, user['id'])) as cursor:
-        req = await cursor.fetchone()
-        if not req:
-            raise HTTPException(404, "Request not found")
+    req = await fetch_one(db, "SELECT sender_id, receiver_id FROM friend_requests WHERE id = ? AND receiver_id = ? AND status = 'pending'", (action.request_id, user['id']))
+    if not req:
+        raise HTTPException(404, "Request not found")
             
     sender_id = req['sender_id']
     me_id = user['id']
     
     # Add bidirectional friendship
-    await db.execute("INSERT INTO friends (user_id, friend_id) VALUES (?, ?)", (me_id, sender_id))
-    await db.execute("INSERT INTO friends (user_id, friend_id) VALUES (?, ?)", (sender_id, me_id))
+    await db.executemany("INSERT INTO friends (user_id, friend_id) VALUES (?, ?)", [(me_id, sender_id), (sender_id, me_id)])
     
     # Update request status -> accepted (or delete it. Let's delete to keep clean? Or keep history. Let's delete for simplicity or set accepted)
     # Keeping history is nice, but removing is cleaner for uniqueness if they unfriend later.
@@ -337,47 +503,64 @@ async def accept_friend_request(action: FriendAction, user = Depends(get_current
     return {"success": True}
 
 @app.post("/api/friends/requests/reject")
-async def reject_friend_request(action: FriendAction, user = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
-    async with db.execute("DELETE FROM friend_requests WHERE id = ? AND receiver_id = ?", (action.request_id, user['id'])) as cursor:
-        if cursor.rowcount == 0:
-             raise HTTPException(404, "Request not found")
+async def reject_friend_request(action: FriendAction, user = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db_write)):
+    cursor = await db.execute("DELETE FROM friend_requests WHERE id = ? AND receiver_id = ?", (action.request_id, user['id']))
+    if cursor.rowcount == 0:
+         raise HTTPException(404, "Request not found")
     await db.commit()
     return {"success": True}
 
 @app.patch("/api/user/settings")
-async def update_settings(request: Request, user = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
-    # Accept any settings dict
-    body = await request.json()
+async def update_settings(request: SettingsUpdate, user = Depends(get_current_user)):
+    # Accept any settings dict; exclude_unset keeps exactly the keys the client sent
+    body = request.model_dump(exclude_unset=True)
     
-    # Save to DB
-    await db.execute("UPDATE users SET settings = ? WHERE id = ?", (json.dumps(body), user['id']))
-    await db.commit()
+    # Save to DB; the write lock is released before any model load below
+    async with write_connection() as db:
+        await db.execute("UPDATE users SET settings = ? WHERE id = ?", (request.model_dump_json(exclude_unset=True), user['id']))
+        await db.commit()
+    invalidate_user(user['id'])
     
     # Check if preferred_model changed
-    preferred = body.get("preferred_model")
+    preferred = request.preferred_model
     if preferred:
-        print(f"Switching model to: {preferred}")
-        llm_engine.set_active_model(preferred)
+        logger.info("Switching model to: %s", preferred)
+        await set_active_model(preferred)
         
     return {"message": "Settings updated", "settings": body}
 
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")
+_models_cache = None  # (st_mtime_ns of MODELS_DIR, [gguf filenames])
+
+def list_model_files():
+    # Scan models directory for .gguf files; a single stat tells whether the
+    # listing can have changed since the last scan
+    global _models_cache
+    try:
+        mtime = os.stat(MODELS_DIR).st_mtime_ns
+    except FileNotFoundError:
+        return []
+    if _models_cache is not None and _models_cache[0] == mtime:
+        return _models_cache[1]
+    with os.scandir(MODELS_DIR) as entries:
+        files = [entry.name for entry in entries if entry.name.endswith(".gguf")]
+    _models_cache = (mtime, files)
+    return files
+
 @app.get("/api/models/available")
 async def get_models():
     status = llm_engine.get_status()
     models = []
     
-    # Scan models directory for .gguf files
-    models_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")
-    if os.path.exists(models_dir):
-        for f in os.listdir(models_dir):
-            if f.endswith(".gguf"):
-                name = f.replace(".gguf", "")
-                models.append({
-                    "name": name,
-                    "type": "local",
-                    "details": "Embedded GGUF",
-                    "active": status['model'] == f
-                })
+    # Only filenames are cached; the active flag is worked out per call
+    for f in await asyncio.to_thread(list_model_files):
+        name = f.replace(".gguf", "")
+        models.append({
+            "name": name,
+            "type": "local",
+            "details": "Embedded GGUF",
+            "active": status['model'] == f
+        })
                 
     # If list empty but engine loaded something (e.g. legacy model.gguf), add it
     if not models and status['status'] == 'loaded':
@@ -385,16 +568,32 @@ async def get_models():
          
     return models
 
+# Downloads run one at a time on worker threads, and a model already being
+# fetched isn't queued again when the pull button is clicked repeatedly.
+# Task handles are kept per model so finished ones can be told apart from running ones.
+_dl_sem = asyncio.Semaphore(1)
+_dl_tasks: dict[str, asyncio.Task] = {}
+
+async def _do_pull(model_name):
+    global _models_cache
+    try:
+        async with _dl_sem:
+            await asyncio.to_thread(llm_engine.download_model, model_name)
+    except Exception:
+        logger.exception("Download of model '%s' failed", model_name)
+    finally:
+        # A new .gguf may have landed in MODELS_DIR
+        _models_cache = None
+
 @app.post("/api/models/pull")
-async def pull_model(request: Request):
-    # Trigger download
-    # Make async in background? For now blocking is easier to code but bad UX.
-    # Let's just mock the trigger or try to run in thread.
-    body = await request.json()
-    model_name = body.get("model_name") or body.get("model") or "tinyllama"
+async def pull_model(request: PullModelRequest):
+    # Trigger download in the background
+    model_name = request.model_name or request.model or "tinyllama"
     
-    import threading
-    threading.Thread(target=llm_engine.download_model, args=(model_name,)).start()
+    task = _dl_tasks.get(model_name)
+    if task is not None and not task.done():
+        return {"message": f"Model '{model_name}' is already downloading."}
+    _dl_tasks[model_name] = asyncio.create_task(_do_pull(model_name))
     return {"message": f"Model '{model_name}' download started. Check backend logs."}
 
 @app.get("/api/models/download-status")
@@ -404,116 +603,110 @@ async def get_download_status():
 
 
 @app.post("/api/riddle/generate")
-async def generate_riddle(request: RiddleRequest, user = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+async def generate_riddle(request: RiddleRequest, user = Depends(get_current_user)):
     # Check if this user has an ACTIVE (playing) riddle for this difficulty
-    today = date.today().isoformat()
-    logging.info(f"Generating request for user {user['username']} - Difficulty: {request.difficulty}")
+    today = date.today()
+    logger.info("Generating request for user %s - Difficulty: %s", user['username'], request.difficulty)
 
     riddle_id = None
     
     # query user progress for 'playing' status on this difficulty
     # Note: user_progress links user to riddle. We need to join with riddles to check difficulty.
-    async with db.execute("""
-        SELECT r.id FROM user_progress up 
-        JOIN riddles r ON up.riddle_id = r.id 
-        WHERE up.user_id = ? AND r.difficulty = ? AND up.status = 'playing'
-    """, (user['id'], request.difficulty)) as cursor:
-        active_riddle = await cursor.fetchone()
+    # The same query returns the riddle content, so resuming needs no further lookups.
+    # The reader is handed back before generation: a request queued on LLM_EXECUTOR must not
+    # sit on a pooled connection while it waits.
+    async with read_connection() as db:
+        riddle_data = await fetch_one(db, """
+            SELECT r.id, r.content, r.answer FROM user_progress up 
+            JOIN riddles r ON up.riddle_id = r.id 
+            WHERE up.user_id = ? AND r.difficulty = ? AND up.status = 'playing'
+            LIMIT 1
+        """, (user['id'], request.difficulty))
         
-    if active_riddle:
+    if riddle_data:
         # Resume existing
-        print(f"Resuming active riddle ID: {active_riddle['id']}")
-        riddle_id = active_riddle['id']
+        logger.info("Resuming active riddle ID: %s", riddle_data['id'])
+        riddle_id = riddle_data['id']
     else:
         # Generate NEW unique riddle
-        import uuid
         request_id = str(uuid.uuid4())
-        print(f"No active riddle found. Genering NEW one for {user['username']}... (ReqID: {request_id})")
-        gen = llm_engine.generate_riddle(request.difficulty, theme=request.theme, seed=request.seed, request_id=request_id)
-        print(f"Generated content: {gen}")
+        logger.info("No active riddle found. Generating NEW one for %s... (ReqID: %s)", user['username'], request_id)
+        gen = await asyncio.get_running_loop().run_in_executor(
+            LLM_EXECUTOR,
+            functools.partial(llm_engine.generate_riddle, request.difficulty, theme=request.theme, seed=request.seed, request_id=request_id)
+        )
+        logger.debug("Generated content: %s", gen)
         
         # Insert into riddles (we treat riddles table as a pool, but here we just add to it)
-        await db.execute("INSERT INTO riddles (content, answer, difficulty, date_for, user_id) VALUES (?, ?, ?, ?, ?)",
-                         (gen['riddle'], gen['answer'], request.difficulty, today, user['id']))
-        await db.commit()
-        
-        # Get the ID of the just inserted riddle
-        async with db.execute("SELECT last_insert_rowid()") as cursor:
-             row = await cursor.fetchone()
-             riddle_id = row[0]
-             
-    # Create or Get progress (if we just created it, it won't exist. If we resumed, it exists)
-    async with db.execute("SELECT * FROM user_progress WHERE user_id = ? AND riddle_id = ?", (user['id'], riddle_id)) as cursor:
-        progress = await cursor.fetchone()
-        
-    if not progress:
-        await db.execute("INSERT INTO user_progress (user_id, riddle_id, guesses, status) VALUES (?, ?, ?, ?)",
-                         (user['id'], riddle_id, "[]", "playing"))
-        await db.commit()
-        # Re-fetch progress
-        async with db.execute("SELECT * FROM user_progress WHERE user_id = ? AND riddle_id = ?", (user['id'], riddle_id)) as cursor:
-            progress = await cursor.fetchone()
-    
-    # Return details expected by legacy frontend
-    # It expects: riddle_id, riddle, answer_length, max_guesses
-    # Fetch content
-    async with db.execute("SELECT * FROM riddles WHERE id = ?", (riddle_id,)) as cursor:
-        riddle_data = await cursor.fetchone()
+        # RETURNING hands back the new id and content, so no rowid / re-select round-trips
+        # Only take the write connection once generation is done, not while the model runs
+        async with write_connection() as wdb:
+            riddle_data = await fetch_one(wdb, "INSERT INTO riddles (content, answer, difficulty, date_for, user_id) VALUES (?, ?, ?, ?, ?) RETURNING id, content, answer",
+                                          (gen['riddle'], gen['answer'], request.difficulty, today.isoformat(), user['id']))
+            riddle_id = riddle_data['id']
+            
+            # A brand new riddle never has progress yet, so create it directly
+            await wdb.execute("INSERT INTO user_progress (user_id, riddle_id, guesses, status) VALUES (?, ?, ?, ?)",
+                              (user['id'], riddle_id, "[]", "playing"))
+            await wdb.commit()
         
-    guess_map = {"easy": 5, "medium": 4, "hard": 3, "very_hard": 2, "insane": 1}
-    
     return {
         "riddle_id": riddle_id,
         "riddle": riddle_data['content'],
         "answer_length": len(riddle_data['answer']),
-        "max_guesses": guess_map.get(request.difficulty, 3),
+        "max_guesses": GUESS_MAP.get(request.difficulty, 3),
         "difficulty": request.difficulty,
-        "day": date.today().day,
-        "month": date.today().strftime("%Y-%m")
+        "day": today.day,
+        "month": today.strftime("%Y-%m")
     }
 
 @app.post("/api/riddle/guess")
-async def submit_guess(request: GuessRequest, user = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db)):
+async def submit_guess(request: GuessRequest, user = Depends(get_current_user), db: aiosqlite.Connection = Depends(get_db_write)):
     riddle_id = request.riddle_id
     guess_text = request.guess
     
-    async with db.execute("SELECT * FROM riddles WHERE id = ?", (riddle_id,)) as cursor:
-        riddle = await cursor.fetchone()
-        if not riddle:
-             raise HTTPException(404, "Riddle not found")
-
-    async with db.execute("SELECT * FROM user_progress WHERE user_id = ? AND riddle_id = ?", (user['id'], riddle_id)) as cursor:
-        progress = await cursor.fetchone()
+    # JSON can carry lone surrogates, which sqlite3 can't bind as UTF-8 text. The
+    # normalized bytes double as the comparison key below.
+    try:
+        guess_key = guess_text.lower().strip().encode("utf-8")
+    except UnicodeEncodeError:
+        raise HTTPException(400, "Invalid guess")
     
-    guesses = json.loads(progress['guesses']) if progress else []
+    # Take the write lock up front: the guess count read here decides the UPDATE below
+    await db.execute("BEGIN IMMEDIATE")
     
+    # Riddle and this user's progress in one lookup; only the guess count is needed, not the history
+    riddle = await fetch_one(db, """
+        SELECT r.answer, r.difficulty, up.status, json_array_length(up.guesses) AS guess_count
+        FROM riddles r
+        LEFT JOIN user_progress up ON up.riddle_id = r.id AND up.user_id = ?
+        WHERE r.id = ?
+    """, (user['id'], riddle_id))
+    if not riddle:
+         raise HTTPException(404, "Riddle not found")
     
-    if progress and progress['status'] in ['solved', 'failed']:
-         return {"correct": progress['status'] == 'solved', "answer": riddle['answer'], "score": 0, "breakdown": {"base": 0}}
+    answer, difficulty, progress_status, guess_count = riddle
+    guess_count = guess_count or 0
+    
+    if progress_status in ['solved', 'failed']:
+         return {"correct": progress_status == 'solved', "answer": answer, "score": 0, "breakdown": {"base": 0}}
 
     # Logic
-    is_correct = guess_text.lower().strip() == riddle['answer'].lower().strip()
+    # Both sides normalized the same way; constant-time so response timing doesn't leak the answer
+    is_correct = hmac.compare_digest(guess_key, answer.lower().strip().encode("utf-8"))
     status_val = "solved" if is_correct else "playing"
     
+    # Max guesses for the difficulty
+    max_guesses = GUESS_MAP.get(difficulty, 3)
+    
     # Calculate score
     # Formula: Difficulty base + (time_remaining_fraction * difficulty base) + remaining guesses (100 each)
     score = 0
     if is_correct:
-        diff_base_map = {
-            "easy": 100, 
-            "medium": 200, 
-            "hard": 300, 
-            "very_hard": 400, 
-            "insane": 500
-        }
-        base_points = diff_base_map.get(riddle['difficulty'], 100)
-        
-        # Max guesses for the difficulty
-        guess_map = {"easy": 5, "medium": 4, "hard": 3, "very_hard": 2, "insane": 1}
-        max_g = guess_map.get(riddle['difficulty'], 3)
+        base_points = BASE_POINTS.get(difficulty, 100)
         
-        guesses_taken = len(guesses) # current list includes the just added correct guess
-        guesses_remaining = max_g - guesses_taken
+        guesses_taken = guess_count # guesses made before this one
+        guesses_remaining = max_guesses - guesses_taken
         
         # Assuming time_remaining is in seconds, and max time is 120 (hardcoded in frontend)
         # (hidden time remaining * difficulty base) -> Interpret as fraction of time left * base
@@ -533,35 +726,36 @@ async def submit_guess(request: GuessRequest, user = Depends(get_current_user),
         
         score = base_points + time_bonus + guess_bonus
 
-    guess_entry = {"word": guess_text, "correct": is_correct}
-    guesses.append(guess_entry)
-    
-    guess_map = {"easy": 5, "medium": 4, "hard": 3, "very_hard": 2, "insane": 1}
-    max_guesses = guess_map.get(riddle['difficulty'], 3)
-    
-    if not is_correct and len(guesses) >= max_guesses:
+    if not is_correct and guess_count + 1 >= max_guesses:
         status_val = "failed"
 
-    await db.execute("UPDATE user_progress SET guesses = ?, status = ? WHERE user_id = ? AND riddle_id = ?",
-                     (json.dumps(guesses), status_val, user['id'], riddle_id))
+    # Append {"word", "correct"} to the stored JSON list in SQL instead of round-tripping it through Python
+    await db.execute("""
+        UPDATE user_progress
+        SET guesses = json_insert(guesses, '$[#]', json_object('word', ?, 'correct', json(?))), status = ?
+        WHERE user_id = ? AND riddle_id = ?
+    """, (guess_text, "true" if is_correct else "false", status_val, user['id'], riddle_id))
                      
     if is_correct:
-        print(f"User {user['username']} (ID: {user['id']}) solved riddle {riddle_id}.")
-        print(f"Score Calc: Base {base_points} + TimeBonus {time_bonus} + GuessBonus {guess_bonus} = {score}")
+        logger.info("User %s (ID: %s) solved riddle %s.", user['username'], user['id'], riddle_id)
+        logger.debug("Score Calc: Base %s + TimeBonus %s + GuessBonus %s = %s", base_points, time_bonus, guess_bonus, score)
         await db.execute("UPDATE users SET total_score = total_score + ? WHERE id = ?", (score, user['id']))
-        print("User score updated in DB.")
 
     await db.commit()
     
     if is_correct:
+        # Drop cached copies after the commit; loads already in flight see the bumped
+        # generations and don't store what they read
+        invalidate_leaderboard()
+        invalidate_user(user['id'])
         return {
             "correct": True,
-            "answer": riddle['answer'],
+            "answer": answer,
             "score": score,
             "breakdown": {"base": score}
         }
     else:
-        return {"correct": False, "answer": None if status_val == "playing" else riddle['answer']}
+        return {"correct": False, "answer": None if status_val == "playing" else answer}
 
 
 # --- Static Files ---
@@ -22,7 +22,6 @@ hidden_imports = backend_imports + [
     'uvicorn.protocols.websockets.auto',
     'uvicorn.lifespan.on',
     'engineio.async_drivers.threading',
-    'passlib.handlers.bcrypt',
     # Explicitly add backend modules if collect_submodules misses them due to missing __init__.py
     'backend.database',
     'backend.llm',
@@ -3,8 +3,6 @@ import sys
 import threading
 import uvicorn
 import webview
-import socket
-import time
 
 # Handle path resolution for both dev and PyInstaller environment
 if getattr(sys, 'frozen', False):
@@ -32,29 +30,41 @@ def get_free_port():
 
 PORT = get_free_port()
 
-def start_server():
+# Set once uvicorn's startup has finished, successfully or not; server.started then
+# tells which. Startup covers the app's hooks (DB init, pool) *and* binding the socket,
+# so the webview never loads before the server can answer.
+server_ready_event = threading.Event()
+
+class ReadyServer(uvicorn.Server):
+    async def startup(self, sockets=None):
+        try:
+            await super().startup(sockets=sockets)
+        finally:
+            server_ready_event.set()
+
+def create_server():
+    # log_level="warning" suppresses the banner to keep console clean, and there is
+    # no per-request access log for the local webview's own traffic
+    config = uvicorn.Config(app, host="127.0.0.1", port=PORT, log_level="warning", access_log=False)
+    return ReadyServer(config)
+
+def start_server(server):
     # Run the uvicorn server programmatically
-    # log_level="error" suppresses the banner to keep console clean
-    uvicorn.run(app, host="127.0.0.1", port=PORT, log_level="info")
+    server.run()
 
 def main():
     print(f"Starting Perplexed Launcher on port {PORT}...")
     
     # Start the server in a separate daemon thread
-    t = threading.Thread(target=start_server)
+    server = create_server()
+    t = threading.Thread(target=start_server, args=(server,))
     t.daemon = True
     t.start()
     
-    # Wait a moment for server to spin up
-    max_retries = 20
-    server_ready = False
-    for i in range(max_retries):
-        try:
-            with socket.create_connection(("127.0.0.1", PORT), timeout=0.1):
-                server_ready = True
-                break
-        except (OSError, ConnectionRefusedError):
-            time.sleep(0.5)
+    # Wait for the server to spin up (same 10s budget the old port polling had);
+    # a failed startup (e.g. port taken) ends the wait right away
+    server_ready_event.wait(timeout=10)
+    server_ready = server.started
             
     if not server_ready:
         print("Server failed to start in time. Check logs.")